@@ -1,23 +1,43 @@
 import os
 import json
 import random
+import sys
 import asyncio
 import logging
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (
     Message,
     CallbackQuery,
+    TelegramObject,
+    InputMediaPhoto,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types.input_file import FSInputFile
+from aiogram.methods import GetUpdates, Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types.input_file import BufferedInputFile, FSInputFile
+from aiolimiter import AsyncLimiter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logging.basicConfig(level=logging.INFO)
@@ -31,42 +51,251 @@ if not TOKEN:
 
 CARDS_JSON = "cards.json"
 IMAGES_DIR = "cards"
+# Кеш file_id по имени картинки. Рядом с каждым id хранится размер и
+# mtime файла: если картинку заменили под тем же именем, старый id
+# отбрасывается и карта выгружается заново
+FILE_IDS_JSON = "file_ids.json"
+
+# PRELOAD_IMAGES=1 читает картинки в память при старте. Колода весит
+# ~357 МБ (78 PNG по ~5 МБ), поэтому по умолчанию выключено: байты нужны
+# только для первой выгрузки, дальше карты уходят по file_id
+PRELOAD_IMAGES = os.getenv("PRELOAD_IMAGES", "0") == "1"
+
+STATE_CACHE_SIZE = 10_000
+
+# Telegram пропускает около 30 сообщений в секунду на бота
+OUTBOUND_RATE = 29
+
+# Сколько апдейтов обрабатывается одновременно
+HANDLER_CONCURRENCY = 256
+
+# Сколько карт может отправляться одновременно
+SEND_CONCURRENCY = 32
+
+# Таймауты запросов к Bot API, секунды. 30 с хватает для JSON-вызовов,
+# но не для выгрузки картинок: карты весят ~5 МБ, и при SEND_CONCURRENCY
+# одновременных выгрузках это до 160 МБ — за 30 с нужен канал ~43 Мбит/с.
+# Для выгрузок отдельный таймаут (~11 Мбит/с на тот же объём)
+SESSION_TIMEOUT = 30
+UPLOAD_TIMEOUT = 120
+
+# Лимиты Telegram на длину подписи к фото и размер альбома
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
 
 TAROT_CARDS: List[Dict[str, Any]] = []
 
+# Собственный генератор для вытягивания карт, отдельно от модуля random
+_rng = random.Random()
+
+# Перетасованный порядок колоды: карты идут по нему, пока колода
+# не закончится, затем она тасуется заново
+_deck_order: List[int] = []
+_deck_cursor = 0
+
+
+def read_json(path: str) -> Any:
+    with open(path, "rb") as f:
+        raw = f.read()
+
+    if orjson is not None:
+        return orjson.loads(raw)
+
+    return json.loads(raw)
+
+
+def orjson_dumps(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
+def image_fingerprint(stat: os.stat_result) -> Dict[str, int]:
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def list_image_files(directory: str) -> Dict[str, Dict[str, int]]:
+    # Один проход scandir по каталогу: каталоги отсеиваются по типу записи,
+    # а размер и mtime для отпечатка берутся из той же записи
+    if not os.path.isdir(directory):
+        return {}
+
+    with os.scandir(directory) as entries:
+        return {
+            entry.name: image_fingerprint(entry.stat())
+            for entry in entries
+            if entry.is_file()
+        }
+
 
 def load_cards(path: str) -> List[Dict[str, Any]]:
     if not os.path.exists(path):
         raise FileNotFoundError(f"Не найден файл {path}")
 
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = read_json(path)
 
     if "cards" not in data or not isinstance(data["cards"], list):
         raise ValueError(f"{path} должен содержать ключ 'cards'")
 
-    return data["cards"]
+    cards = data["cards"]
+    missing = []
 
+    existing_images = list_image_files(IMAGES_DIR)
 
-def draw_card_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="🔮 Карта из Колоды Мягкой Стихии",
-                    callback_data="draw_card",
-                )
-            ]
-        ]
+    for index, card in enumerate(cards):
+        # Ключи интернируются, списки (например, descriptions) становятся
+        # кортежами — карты после загрузки не меняются
+        card = cards[index] = {
+            sys.intern(key): tuple(value) if isinstance(value, list) else value
+            for key, value in card.items()
+        }
+
+        for key in ("name", "image"):
+            if isinstance(card.get(key), str):
+                card[key] = sys.intern(card[key])
+
+        name = str(card.get("name") or card.get("title") or "").strip()
+        caption = f"<b>{name}</b>" if name else ""
+        text = str(card.get("text", "")).strip()
+
+        # Текст карты уходит в подпись, если помещается, — одно сообщение
+        # вместо двух
+        full_caption = "\n\n".join(part for part in (caption, text) if part)
+
+        if len(full_caption) <= CAPTION_LIMIT:
+            caption, text = full_caption, ""
+
+        card["_caption"] = caption
+        card["_text"] = text
+
+        image = str(card.get("image", "")).strip()
+
+        card["_path"] = os.path.join(IMAGES_DIR, image) if image else ""
+        # Имена с подкаталогом (major/TheFool.png) в листинге не найти
+        if os.path.basename(image) == image:
+            fingerprint = existing_images.get(image)
+        elif os.path.isfile(card["_path"]):
+            fingerprint = image_fingerprint(os.stat(card["_path"]))
+        else:
+            fingerprint = None
+
+        card["_fingerprint"] = fingerprint
+        card["_has_image"] = fingerprint is not None
+
+        if image and not card["_has_image"]:
+            missing.append(card["_path"])
+
+    # Без картинки карта всё равно выдаётся — текстом, колода не пустеет
+    if missing:
+        logger.warning("Card images not found: %s", ", ".join(missing))
+
+    return cards
+
+
+def load_card_image(card: Dict[str, Any], preload: bool = True) -> None:
+    if not preload:
+        # Картинка будет читаться с диска при каждой выгрузке
+        card["_input_file"] = FSInputFile(card["_path"])
+        return
+
+    with open(card["_path"], "rb") as f:
+        data = f.read()
+
+    # Один InputFile на карту: BufferedInputFile можно отправлять повторно
+    card["_input_file"] = BufferedInputFile(
+        data,
+        filename=os.path.basename(card["_path"]),
     )
 
 
-def field_is_quiet_text() -> str:
-    return "Сегодня Поле молчит чуть тише обычного 🤍"
+# Ошибки Telegram, после которых кешированный file_id надо выбросить.
+# Остальные 400 (chat not found, битая разметка подписи) повторная
+# выгрузка не исправит
+STALE_FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference",
+)
+
+
+def is_stale_file_id_error(error: TelegramBadRequest) -> bool:
+    text = error.message.lower()
+    return any(marker in text for marker in STALE_FILE_ID_ERRORS)
+
+
+def remember_file_id(card: Dict[str, Any], file_id: str) -> None:
+    card["_file_id"] = file_id
+
+    # После выгрузки байты в памяти больше не нужны: если Telegram
+    # когда-нибудь отвергнет file_id, картинка прочитается с диска
+    if isinstance(card.get("_input_file"), BufferedInputFile):
+        card["_input_file"] = FSInputFile(card["_path"])
+
+
+def load_file_ids(path: str, cards: List[Dict[str, Any]]) -> int:
+    if not os.path.exists(path):
+        return 0
+
+    file_ids = read_json(path)
+
+    loaded = 0
+
+    for card in cards:
+        entry = file_ids.get(card.get("image"))
+        fingerprint = card.get("_fingerprint")
+
+        # Записи без отпечатка (старый формат) или от другого файла
+        # пропускаем — карта выгрузится заново
+        if not isinstance(entry, dict) or not entry.get("file_id"):
+            continue
+
+        if fingerprint is None or any(
+            entry.get(key) != value for key, value in fingerprint.items()
+        ):
+            continue
+
+        card["_file_id"] = entry["file_id"]
+        loaded += 1
+
+    return loaded
+
+
+def save_file_ids(path: str, cards: List[Dict[str, Any]]) -> None:
+    file_ids = {
+        card["image"]: {"file_id": card["_file_id"], **card["_fingerprint"]}
+        for card in cards
+        if card.get("_file_id") and card.get("_fingerprint")
+    }
+
+    # Пишем во временный файл и подменяем целиком, чтобы падение во время
+    # записи не оставило обрезанный JSON
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(file_ids, f, ensure_ascii=False, indent=2)
+
+    os.replace(tmp_path, path)
+
+
+DRAW_CARD_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="🔮 Карта из Колоды Мягкой Стихии",
+                callback_data="draw_card",
+            )
+        ]
+    ]
+)
+
+
+FIELD_IS_QUIET_TEXT = "Сегодня Поле молчит чуть тише обычного 🤍"
+NEXT_QUESTION_TEXT = "Задай Полю следующий вопрос 🤍"
+
+
+send_slots = asyncio.Semaphore(SEND_CONCURRENCY)
 
 
 async def send_card_text(message: Message, card: Dict[str, Any]) -> None:
-    text = str(card.get("text", "")).strip()
+    text = card["_text"]
 
     if not text:
         return
@@ -74,31 +303,156 @@ async def send_card_text(message: Message, card: Dict[str, Any]) -> None:
     await message.answer(text)
 
 
+async def answer_card_photo(
+    message: Message,
+    card: Dict[str, Any],
+    caption: str,
+) -> None:
+    file_id = card.get("_file_id")
+
+    if file_id:
+        try:
+            await message.answer_photo(
+                photo=file_id,
+                caption=caption,
+                reply_markup=DRAW_CARD_KB,
+            )
+            return
+        except TelegramBadRequest as e:
+            # file_id из file_ids.json мог устареть, например при смене токена
+            if not is_stale_file_id_error(e):
+                raise
+
+            logger.warning("Cached file_id rejected for %s", card.get("image"))
+            card.pop("_file_id", None)
+
+    sent = await message.bot(
+        message.answer_photo(
+            photo=card["_input_file"],
+            caption=caption,
+            reply_markup=DRAW_CARD_KB,
+        ),
+        request_timeout=UPLOAD_TIMEOUT,
+    )
+
+    # Гонка между задачами не страшна: file_id для одного файла одинаковый
+    if sent.photo:
+        remember_file_id(card, sent.photo[-1].file_id)
+
+
 async def send_one_card(message: Message, card: Dict[str, Any]) -> None:
-    name = str(card.get("name") or card.get("title") or "").strip()
-    image = str(card.get("image", "")).strip()
+    caption = card["_caption"]
+
+    async with send_slots:
+        if card["_has_image"]:
+            await answer_card_photo(message, card, caption)
+        else:
+            await message.answer(
+                caption or FIELD_IS_QUIET_TEXT,
+                reply_markup=DRAW_CARD_KB,
+            )
+
+        await send_card_text(message, card)
+
+
+async def answer_cards_album(
+    message: Message,
+    cards: List[Dict[str, Any]],
+) -> None:
+    def album(use_file_ids: bool) -> List[InputMediaPhoto]:
+        media = []
+
+        for card in cards:
+            file_id = card.get("_file_id") if use_file_ids else None
+
+            media.append(
+                InputMediaPhoto(
+                    media=file_id or card["_input_file"],
+                    caption=card["_caption"],
+                )
+            )
+
+        return media
 
-    caption = f"<b>{name}</b>" if name else ""
+    try:
+        sent = await message.bot(
+            message.answer_media_group(album(use_file_ids=True)),
+            request_timeout=UPLOAD_TIMEOUT,
+        )
+    except TelegramBadRequest as e:
+        if not any(card.get("_file_id") for card in cards):
+            raise
 
-    photo_path = os.path.join(IMAGES_DIR, image)
+        if not is_stale_file_id_error(e):
+            raise
 
-    if image and os.path.exists(photo_path):
-        await message.answer_photo(
-            photo=FSInputFile(photo_path),
-            caption=caption,
-            reply_markup=draw_card_keyboard(),
+        logger.warning("Cached file_id rejected in album, re-uploading")
+
+        for card in cards:
+            card.pop("_file_id", None)
+
+        sent = await message.bot(
+            message.answer_media_group(album(use_file_ids=False)),
+            request_timeout=UPLOAD_TIMEOUT,
         )
-    else:
+
+    for card, sent_message in zip(cards, sent):
+        if sent_message.photo:
+            remember_file_id(card, sent_message.photo[-1].file_id)
+
+
+async def send_cards(message: Message, cards: List[Dict[str, Any]]) -> None:
+    # Альбом — один запрос на все карты, но только для 2–10 фото
+    if not 2 <= len(cards) <= MEDIA_GROUP_LIMIT or not all(
+        card["_has_image"] for card in cards
+    ):
+        for card in cards:
+            await send_one_card(message, card)
+        return
+
+    # У альбома нет reply_markup, поэтому клавиатура и длинные тексты
+    # идут одним сообщением следом
+    texts = [card["_text"] for card in cards if card["_text"]]
+
+    async with send_slots:
+        await answer_cards_album(message, cards)
+
         await message.answer(
-            caption or field_is_quiet_text(),
-            reply_markup=draw_card_keyboard(),
+            "\n\n".join(texts) or NEXT_QUESTION_TEXT,
+            reply_markup=DRAW_CARD_KB,
         )
 
-    await send_card_text(message, card)
+
+def draw_next_card() -> Dict[str, Any]:
+    global _deck_cursor
+
+    if _deck_cursor >= len(_deck_order):
+        _deck_order[:] = range(len(TAROT_CARDS))
+        _rng.shuffle(_deck_order)
+        _deck_cursor = 0
+
+    card = TAROT_CARDS[_deck_order[_deck_cursor]]
+    _deck_cursor += 1
+
+    return card
 
 
 router = Router()
 
+# Ограничивает только одновременную работу хендлеров: start_polling
+# всё равно создаёт задачу на каждый апдейт, и ждущие своей очереди
+# апдейты остаются в памяти
+handler_slots = asyncio.BoundedSemaphore(HANDLER_CONCURRENCY)
+
+
+async def limit_concurrency(
+    handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+    event: TelegramObject,
+    data: Dict[str, Any],
+) -> Any:
+    async with handler_slots:
+        return await handler(event, data)
+
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
@@ -108,7 +462,7 @@ async def cmd_start(message: Message, state: FSMContext):
         "Добро пожаловать в пространство Колоды Мягкой Стихии 🤍\n\n"
         "Задай вопрос Полю\n\n"
         "Колода ответит одной из 78 карт",
-        reply_markup=draw_card_keyboard(),
+        reply_markup=DRAW_CARD_KB,
     )
 
 
@@ -116,42 +470,135 @@ async def cmd_start(message: Message, state: FSMContext):
 async def draw_card(callback: CallbackQuery, state: FSMContext):
     await state.set_state(None)
 
+    # Сначала отвечаем на callback, чтобы у кнопки сразу пропали «часики»,
+    # не дожидаясь выгрузки карты
+    await callback.answer()
+
     if not TAROT_CARDS:
         await callback.message.answer(
-            field_is_quiet_text(),
-            reply_markup=draw_card_keyboard(),
+            FIELD_IS_QUIET_TEXT,
+            reply_markup=DRAW_CARD_KB,
         )
-        await callback.answer()
         return
 
-    card = random.choice(TAROT_CARDS)
+    card = draw_next_card()
 
     await send_one_card(callback.message, card)
-    await callback.answer()
 
 
 # -----------------------------
-# Health server для Railway
+# FSM storage
 # -----------------------------
-async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+# Локальный LRU состояний поверх внешнего хранилища. Кеш сбрасывается
+# только собственными записями, поэтому он верен, лишь пока в хранилище
+# пишет один процесс бота. Для long polling так и есть: Telegram не даёт
+# двум процессам читать getUpdates одного токена. Если боту понадобится
+# несколько реплик (например, через webhook), кеш нужно убрать.
+#
+# Что он экономит: FSM-middleware читает состояние на каждый апдейт
+# (один GET), а хендлеры на каждое нажатие ставят None (один DEL).
+# Для «тёплого» пользователя оба запроса в Redis пропускаются.
+class CachedStateStorage(BaseStorage):
+    def __init__(self, storage: BaseStorage, maxsize: int = STATE_CACHE_SIZE):
+        self.storage = storage
+        self.maxsize = maxsize
+        self._states: "OrderedDict[StorageKey, Optional[str]]" = OrderedDict()
+
+    def _remember(self, key: StorageKey, state: Optional[str]) -> None:
+        self._states[key] = state
+        self._states.move_to_end(key)
+
+        if len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+
+        if key in self._states and self._states[key] == value:
+            self._states.move_to_end(key)
+            return
+
+        await self.storage.set_state(key, value)
+        self._remember(key, value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        if key in self._states:
+            self._states.move_to_end(key)
+            return self._states[key]
+
+        value = await self.storage.get_state(key)
+        self._remember(key, value)
+        return value
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await self.storage.get_data(key)
+
+    async def close(self) -> None:
+        self._states.clear()
+        await self.storage.close()
+
+
+def create_storage() -> BaseStorage:
+    redis_url = os.getenv("REDIS_URL")
+
+    if not redis_url:
+        logger.info("REDIS_URL не задан — FSM хранится в памяти")
+        return MemoryStorage()
+
     try:
-        await reader.readline()
+        from aiogram.fsm.storage.redis import RedisStorage
+    except ImportError as e:
+        raise RuntimeError("Для REDIS_URL нужен пакет redis") from e
 
-        while True:
-            line = await reader.readline()
-            if not line or line in (b"\r\n", b"\n"):
-                break
+    logger.info("FSM storage: Redis")
+    return CachedStateStorage(RedisStorage.from_url(redis_url))
 
-        body = b"OK"
 
-        writer.write(
-            b"HTTP/1.1 200 OK\r\n"
-            b"Content-Type: text/plain\r\n"
-            + f"Content-Length: {len(body)}\r\n".encode()
-            + b"\r\n"
-            + body
-        )
+# -----------------------------
+# Ограничение исходящих запросов
+# -----------------------------
+class OutboundRateLimit(BaseRequestMiddleware):
+    def __init__(self, limiter: AsyncLimiter):
+        self.limiter = limiter
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        # Long polling не шлёт сообщений и не должен занимать квоту
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        async with self.limiter:
+            return await make_request(bot, method)
+
+
+# -----------------------------
+# Health server для Railway
+# -----------------------------
+_OK_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 2\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"OK"
+)
+
 
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+
+        writer.write(_OK_RESPONSE)
         await writer.drain()
 
     finally:
@@ -174,6 +621,7 @@ async def start_health_server() -> Optional[asyncio.AbstractServer]:
         _handle_http,
         "0.0.0.0",
         int(port),
+        backlog=128,
     )
 
     logger.info("Health server listening on %s", port)
@@ -184,18 +632,52 @@ async def main():
     global TAROT_CARDS
 
     try:
-        TAROT_CARDS = load_cards(CARDS_JSON)
-        logger.info("Loaded TAROT_CARDS: %d", len(TAROT_CARDS))
+        TAROT_CARDS = await asyncio.to_thread(load_cards, CARDS_JSON)
+
+        try:
+            loaded = load_file_ids(FILE_IDS_JSON, TAROT_CARDS)
+            logger.info("Loaded cached file_ids: %d", loaded)
+        except Exception:
+            logger.exception("Failed to load %s", FILE_IDS_JSON)
+
+        # Картинки читаются параллельно в пуле потоков, не блокируя loop.
+        # Картам с file_id из кеша байты не нужны и при PRELOAD_IMAGES
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(
+                    load_card_image,
+                    card,
+                    PRELOAD_IMAGES and not card.get("_file_id"),
+                )
+                for card in TAROT_CARDS
+                if card["_has_image"]
+            )
+        )
+        logger.info(
+            "Loaded TAROT_CARDS: %d (images preloaded: %s)",
+            len(TAROT_CARDS),
+            PRELOAD_IMAGES,
+        )
     except Exception:
         TAROT_CARDS = []
         logger.exception("Failed to load TAROT_CARDS")
 
+    json_options: Dict[str, Any] = {}
+
+    if orjson is not None:
+        json_options = {"json_loads": orjson.loads, "json_dumps": orjson_dumps}
+
+    session = AiohttpSession(timeout=SESSION_TIMEOUT, **json_options)
+
     bot = Bot(
         TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
+    bot.session.middleware(OutboundRateLimit(AsyncLimiter(OUTBOUND_RATE, 1)))
 
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=create_storage())
+    dp.update.outer_middleware(limit_concurrency)
     dp.include_router(router)
 
     health = await start_health_server()
@@ -208,8 +690,22 @@ async def main():
             health.close()
             await health.wait_closed()
 
+        # Если колода не загрузилась, не затираем сохранённый кеш пустым
+        if TAROT_CARDS:
+            try:
+                save_file_ids(FILE_IDS_JSON, TAROT_CARDS)
+            except Exception:
+                logger.exception("Failed to save %s", FILE_IDS_JSON)
+
         await bot.session.close()
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
     asyncio.run(main())
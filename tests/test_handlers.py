@@ -0,0 +1,289 @@
+import asyncio
+import os
+import sys
+from datetime import datetime
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+
+import bot as tarot_bot  # noqa: E402
+
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.exceptions import TelegramBadRequest  # noqa: E402
+from aiogram.methods import (  # noqa: E402
+    AnswerCallbackQuery,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod,
+)
+from aiogram.types import Chat, Message, PhotoSize, Update  # noqa: E402
+
+
+class RecordingSession(BaseSession):
+    def __init__(self) -> None:
+        super().__init__()
+        self.requests: List[TelegramMethod[Any]] = []
+        self.timeouts: List[Optional[int]] = []
+        # Вернуть текст ошибки, чтобы ответить на запрос 400 Bad Request
+        self.reject: Optional[Callable[[TelegramMethod[Any]], Optional[str]]] = None
+
+    async def make_request(
+        self,
+        bot: Bot,
+        method: TelegramMethod[Any],
+        timeout: Optional[int] = None,
+    ) -> Any:
+        self.requests.append(method)
+        self.timeouts.append(timeout)
+
+        error = self.reject(method) if self.reject else None
+
+        if error:
+            raise TelegramBadRequest(method=method, message=error)
+
+        if isinstance(method, SendMediaGroup):
+            return [
+                self.sent_message(photo=f"file-{len(self.requests)}-{index}")
+                for index in range(len(method.media))
+            ]
+
+        if isinstance(method, SendPhoto):
+            return self.sent_message(photo=f"file-{len(self.requests)}")
+
+        if isinstance(method, SendMessage):
+            return self.sent_message()
+
+        return True
+
+    def sent_message(self, photo: Optional[str] = None) -> Message:
+        return Message(
+            message_id=len(self.requests),
+            date=datetime.now(),
+            chat=Chat(id=1, type="private"),
+            photo=[
+                PhotoSize(file_id=photo, file_unique_id="unique", width=1, height=1)
+            ]
+            if photo
+            else None,
+        )
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:  # pragma: no cover
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+# Роутер бота можно подключить только к одному диспетчеру
+dp = Dispatcher()
+dp.include_router(tarot_bot.router)
+
+
+def draw_card_update(update_id: int) -> Dict[str, Any]:
+    user = {"id": 7, "is_bot": False, "first_name": "Test"}
+
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": "chat",
+            "data": "draw_card",
+            "message": {
+                "message_id": 1,
+                "date": 1_700_000_000,
+                "chat": {"id": 1, "type": "private"},
+                "from": user,
+                "text": "start",
+            },
+        },
+    }
+
+
+def bot_message(bot: Bot) -> Message:
+    return Message.model_validate(
+        draw_card_update(0)["callback_query"]["message"],
+        context={"bot": bot},
+    )
+
+
+def feed(session: RecordingSession, *update_ids: int) -> None:
+    bot = Bot("42:TEST", session=session)
+
+    async def run() -> None:
+        for update_id in update_ids:
+            update = Update.model_validate(
+                draw_card_update(update_id),
+                context={"bot": bot},
+            )
+            await dp.feed_update(bot, update)
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def deck(monkeypatch: pytest.MonkeyPatch) -> List[Dict[str, Any]]:
+    monkeypatch.chdir(ROOT)
+    cards = tarot_bot.load_cards(tarot_bot.CARDS_JSON)[:1]
+
+    for card in cards:
+        tarot_bot.load_card_image(card, preload=False)
+
+    monkeypatch.setattr(tarot_bot, "TAROT_CARDS", cards)
+    monkeypatch.setattr(tarot_bot, "_deck_order", [])
+    monkeypatch.setattr(tarot_bot, "_deck_cursor", 0)
+    return cards
+
+
+def test_draw_card_uploads_once_then_sends_file_id(deck):
+    session = RecordingSession()
+
+    feed(session, 1, 2)
+
+    assert [type(method) for method in session.requests] == [
+        AnswerCallbackQuery,
+        SendPhoto,
+        AnswerCallbackQuery,
+        SendPhoto,
+    ]
+
+    first, second = session.requests[1], session.requests[3]
+    assert not isinstance(first.photo, str)
+    assert second.photo == deck[0]["_file_id"] == "file-2"
+    assert session.timeouts[1] == tarot_bot.UPLOAD_TIMEOUT
+
+
+def test_draw_card_with_empty_deck_answers_quietly(monkeypatch):
+    monkeypatch.setattr(tarot_bot, "TAROT_CARDS", [])
+    session = RecordingSession()
+
+    feed(session, 3)
+
+    assert [type(method) for method in session.requests] == [
+        AnswerCallbackQuery,
+        SendMessage,
+    ]
+    assert session.requests[1].text == tarot_bot.FIELD_IS_QUIET_TEXT
+
+
+def reject_cached_photo(error: str) -> Callable[[TelegramMethod[Any]], Optional[str]]:
+    def reject(method: TelegramMethod[Any]) -> Optional[str]:
+        if isinstance(method, SendPhoto) and isinstance(method.photo, str):
+            return error
+        return None
+
+    return reject
+
+
+def test_stale_file_id_is_dropped_and_photo_reuploaded(deck):
+    card = deck[0]
+    card["_file_id"] = "stale"
+    session = RecordingSession()
+    session.reject = reject_cached_photo(
+        "Bad Request: wrong file identifier/HTTP URL specified"
+    )
+    bot = Bot("42:TEST", session=session)
+
+    asyncio.run(
+        tarot_bot.answer_card_photo(bot_message(bot), card, card["_caption"])
+    )
+
+    assert [method.photo for method in session.requests][0] == "stale"
+    assert not isinstance(session.requests[1].photo, str)
+    assert card["_file_id"] == "file-2"
+
+
+def test_other_bad_request_keeps_cached_file_id(deck):
+    card = deck[0]
+    card["_file_id"] = "cached"
+    session = RecordingSession()
+    session.reject = reject_cached_photo("Bad Request: chat not found")
+    bot = Bot("42:TEST", session=session)
+
+    with pytest.raises(TelegramBadRequest):
+        asyncio.run(
+            tarot_bot.answer_card_photo(bot_message(bot), card, card["_caption"])
+        )
+
+    assert len(session.requests) == 1
+    assert card["_file_id"] == "cached"
+
+
+@pytest.fixture
+def spread(monkeypatch: pytest.MonkeyPatch) -> List[Dict[str, Any]]:
+    monkeypatch.chdir(ROOT)
+    cards = tarot_bot.load_cards(tarot_bot.CARDS_JSON)[:3]
+
+    for card in cards:
+        tarot_bot.load_card_image(card, preload=False)
+
+    return cards
+
+
+def test_cards_are_sent_as_one_album_then_keyboard(spread):
+    session = RecordingSession()
+    bot = Bot("42:TEST", session=session)
+
+    asyncio.run(tarot_bot.send_cards(bot_message(bot), spread))
+
+    assert [type(method) for method in session.requests] == [
+        SendMediaGroup,
+        SendMessage,
+    ]
+    assert session.timeouts[0] == tarot_bot.UPLOAD_TIMEOUT
+    assert session.requests[1].reply_markup == tarot_bot.DRAW_CARD_KB
+    assert [card["_file_id"] for card in spread] == [
+        "file-1-0",
+        "file-1-1",
+        "file-1-2",
+    ]
+
+
+def test_stale_album_file_ids_are_dropped_and_album_reuploaded(spread):
+    for card in spread:
+        card["_file_id"] = "stale"
+
+    session = RecordingSession()
+    session.reject = lambda method: (
+        "Bad Request: wrong file identifier/HTTP URL specified"
+        if isinstance(method, SendMediaGroup)
+        and any(isinstance(media.media, str) for media in method.media)
+        else None
+    )
+    bot = Bot("42:TEST", session=session)
+
+    asyncio.run(tarot_bot.send_cards(bot_message(bot), spread))
+
+    albums = [
+        method for method in session.requests if isinstance(method, SendMediaGroup)
+    ]
+    assert len(albums) == 2
+    assert [media.media for media in albums[0].media] == ["stale"] * 3
+    assert not any(isinstance(media.media, str) for media in albums[1].media)
+    assert [card["_file_id"] for card in spread] == [
+        "file-2-0",
+        "file-2-1",
+        "file-2-2",
+    ]
+
+
+def test_no_cards_sends_nothing():
+    session = RecordingSession()
+    bot = Bot("42:TEST", session=session)
+
+    asyncio.run(tarot_bot.send_cards(bot_message(bot), []))
+
+    assert session.requests == []
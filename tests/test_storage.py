@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+
+import bot as tarot_bot  # noqa: E402
+
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+
+@pytest.fixture
+def deck_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cards").mkdir()
+    (tmp_path / "cards" / "TheFool.png").write_bytes(b"fool")
+    (tmp_path / "cards.json").write_text(
+        json.dumps({"cards": [{"name": "Шут", "image": "TheFool.png"}]}),
+        encoding="utf-8",
+    )
+    return tmp_path
+
+
+def test_file_ids_round_trip(deck_dir):
+    cards = tarot_bot.load_cards("cards.json")
+    cards[0]["_file_id"] = "cached"
+    tarot_bot.save_file_ids("file_ids.json", cards)
+
+    reloaded = tarot_bot.load_cards("cards.json")
+
+    assert tarot_bot.load_file_ids("file_ids.json", reloaded) == 1
+    assert reloaded[0]["_file_id"] == "cached"
+
+
+def test_file_id_for_replaced_image_is_ignored(deck_dir):
+    cards = tarot_bot.load_cards("cards.json")
+    cards[0]["_file_id"] = "cached"
+    tarot_bot.save_file_ids("file_ids.json", cards)
+
+    (deck_dir / "cards" / "TheFool.png").write_bytes(b"a new picture")
+    reloaded = tarot_bot.load_cards("cards.json")
+
+    assert tarot_bot.load_file_ids("file_ids.json", reloaded) == 0
+    assert "_file_id" not in reloaded[0]
+
+
+def test_file_ids_without_fingerprint_are_ignored(deck_dir):
+    (deck_dir / "file_ids.json").write_text(
+        json.dumps({"TheFool.png": "old-format"}),
+        encoding="utf-8",
+    )
+    cards = tarot_bot.load_cards("cards.json")
+
+    assert tarot_bot.load_file_ids("file_ids.json", cards) == 0
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: Counter = Counter()
+
+    async def set_state(self, key, state=None):
+        self.calls["set_state"] += 1
+        await super().set_state(key, state)
+
+    async def get_state(self, key):
+        self.calls["get_state"] += 1
+        return await super().get_state(key)
+
+    async def set_data(self, key, data):
+        self.calls["set_data"] += 1
+        await super().set_data(key, data)
+
+    async def get_data(self, key):
+        self.calls["get_data"] += 1
+        return await super().get_data(key)
+
+
+def user_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+def test_repeated_state_write_skips_backend():
+    backend = CountingStorage()
+    storage = tarot_bot.CachedStateStorage(backend)
+
+    async def run():
+        await storage.set_state(user_key(1), None)
+        await storage.set_state(user_key(1), None)
+
+    asyncio.run(run())
+
+    assert backend.calls["set_state"] == 1
+
+
+def test_cached_state_read_skips_backend():
+    backend = CountingStorage()
+    storage = tarot_bot.CachedStateStorage(backend)
+
+    async def run():
+        # Неизвестный ключ читается из хранилища один раз, дальше None из кеша
+        assert await storage.get_state(user_key(1)) is None
+        assert await storage.get_state(user_key(1)) is None
+
+        await storage.set_state(user_key(2), "flow:question")
+        assert await storage.get_state(user_key(2)) == "flow:question"
+
+    asyncio.run(run())
+
+    assert backend.calls["get_state"] == 1
+
+
+def test_changed_state_is_written_through():
+    backend = CountingStorage()
+    storage = tarot_bot.CachedStateStorage(backend)
+
+    async def run():
+        await storage.set_state(user_key(1), None)
+        await storage.set_state(user_key(1), "flow:question")
+        return await backend.get_state(user_key(1))
+
+    assert asyncio.run(run()) == "flow:question"
+    assert backend.calls["set_state"] == 2
+
+
+def test_evicted_state_is_read_from_backend_again():
+    backend = CountingStorage()
+    storage = tarot_bot.CachedStateStorage(backend, maxsize=2)
+
+    async def run():
+        for user_id in (1, 2, 3):
+            await storage.get_state(user_key(user_id))
+
+        # Пользователь 1 вытеснен самым давним, 3 ещё в кеше
+        await storage.get_state(user_key(3))
+        await storage.get_state(user_key(1))
+
+    asyncio.run(run())
+
+    assert backend.calls["get_state"] == 4
+
+
+def test_data_passes_through_to_backend():
+    backend = CountingStorage()
+    storage = tarot_bot.CachedStateStorage(backend)
+
+    async def run():
+        await storage.set_data(user_key(1), {"question": "?"})
+        return await storage.get_data(user_key(1))
+
+    assert asyncio.run(run()) == {"question": "?"}
+    assert backend.calls["set_data"] == 1
+    assert backend.calls["get_data"] == 1